@@ -1,4 +1,5 @@
 import numpy as np
+import tensorflow as tf
 import utils
 from collections import Counter
 import os
@@ -19,6 +20,7 @@ class DataGenerator:
         self.max_size = max_size
         self.preprocessing = preprocessing
         self.x = self.get_content_images()
+        self.x_tensor = None
 
         if self.preprocessing:
             self.x = utils.preprocess(self.x)
@@ -43,6 +45,25 @@ class DataGenerator:
             yield x[access_pattern, ...]
 
 
+    def __len__(self):
+        return len(self.x)
+
+
+    def get_batches(self, batch_size=None):
+        """
+        Shuffled float32 batches for one epoch, the whole dataset is
+        uploaded to the device once and batches are gathered from it
+        """
+        batch_size = batch_size or self.batch_size
+        if self.x_tensor is None:
+            self.x_tensor = tf.constant(self.x, dtype=tf.float32)
+
+        num_samples = self.x_tensor.shape[0]
+        indices = tf.random.shuffle(tf.range(num_samples))
+        for start_idx in range(0, num_samples - batch_size + 1, batch_size):
+            yield tf.gather(self.x_tensor, indices[start_idx:start_idx + batch_size])
+
+
     def get_random_sample(self, test=True):
         if test:
             idx = np.random.randint(0, self.x_test.shape - 1)
@@ -64,12 +85,63 @@ class DataGenerator:
 
 
     def show_imgs(self, img):
-        if len(img.shape) == 4:
-            return utils.show_images(img, self.normalize, self.preprocessing)
+        return show_imgs(img, self.normalize, self.preprocessing)
+
+
+class ImageFolderGenerator:
+    """
+    Content images decoded straight from JPEG files by a parallel
+    tf.data pipeline, used with the same interface as DataGenerator
+    pattern: glob of the image files, e.g "coco/train2017/*.jpg"
+    """
+    def __init__(self, pattern, batch_size, rst, shuffle_size=1024,
+                normalize=True, preprocessing=True):
+        self.pattern = pattern
+        self.batch_size = batch_size
+        self.rst = rst
+        self.shuffle_size = shuffle_size
+        self.normalize = normalize
+        self.preprocessing = preprocessing
+        self.num_files = len(tf.io.gfile.glob(pattern))
+
+
+    def __len__(self):
+        return self.num_files
+
+
+    def load_image(self, path):
+        img = tf.io.decode_jpeg(tf.io.read_file(path), channels=3,
+                                dct_method='INTEGER_FAST')
+        img = tf.image.resize(img, (self.rst, self.rst))
+        # RGB -> BGR, same as the cv2 loaded images
+        img = img[..., ::-1]
 
-        if self.normalize:
-            img = utils.de_norm(img)
         if self.preprocessing:
-            img = utils.deprocess(img)
+            img = img - utils.MEAN_PIXCELS.astype(np.float32)
+        if self.normalize:
+            img = utils.norm(img)
+        return img
+
+
+    def get_batches(self, batch_size=None):
+        ds = tf.data.Dataset.list_files(self.pattern, shuffle=True)
+        ds = ds.map(self.load_image, num_parallel_calls=tf.data.AUTOTUNE)
+        ds = ds.shuffle(self.shuffle_size)
+        ds = ds.batch(batch_size or self.batch_size, drop_remainder=True)
+        return ds.prefetch(tf.data.AUTOTUNE)
+
+
+    def show_imgs(self, img):
+        return show_imgs(img, self.normalize, self.preprocessing)
+
+
+def show_imgs(img, normalize, preprocessing):
+    if len(img.shape) == 4:
+        return utils.show_images(img, normalize, preprocessing)
+
+    if normalize:
+        img = utils.de_norm(img)
+    if preprocessing:
+        img = utils.deprocess(img)
 
-        cv2_imshow(img)
+    cv2_imshow(img)
@@ -1,21 +1,27 @@
 import tensorflow as tf
 import numpy as np
 import datetime
+import functools
+import hashlib
+import os
+import pickle
+import threading
 import matplotlib.pyplot as plt
 import utils
-import tensorflow.keras.backend as K
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from tensorflow.keras.layers import (
     Input, Activation, Layer,
     UpSampling2D, Concatenate,
-    Add, Conv2D)
+    Add, Conv2D, MaxPooling2D)
 from tensorflow.keras.models import Model
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.applications.vgg19 import VGG19
 from ops import (
-    WaveLetPooling, WaveLetUnPooling, TfReduceSum,
-    WhiteningAndColoring, get_predict_function,
-    gram_matrix)
+    WaveLetPooling, WaveLetUnPooling,
+    WhiteningAndColoring, get_predict_function, apply_layers, relaxed_spec,
+    gram_matrix, num_locations)
 
 try:
     # In case run on google colab
@@ -32,89 +38,162 @@ VGG_LAYERS = [
     'block4_conv1',
 ]
 
+VGG_FILTERS = {
+    'block1_conv1': 64, 'block1_conv2': 64,
+    'block2_conv1': 128, 'block2_conv2': 128,
+    'block3_conv1': 256, 'block3_conv2': 256,
+    'block3_conv3': 256, 'block3_conv4': 256,
+    'block4_conv1': 512,
+}
+
+# last conv of each block, followed by a pooling layer
+POOLING_LAYERS = {'block1_conv2', 'block2_conv2', 'block3_conv4'}
+
+# wct layers run by each transfer stage
+TRANSFER_STAGES = {
+    # ===== encoder layers ===== #
+    'en_1': ['in_img', 'block1_conv1_encode'],
+    'pool_1': ['block1_conv2_encode', 'wave_let_pooling_0', 'block2_conv1_encode'],
+    'pool_2': ['block2_conv2_encode', 'wave_let_pooling_1', 'block3_conv1_encode'],
+    'pool_3': [
+        'block3_conv2_encode', 'block3_conv3_encode',
+        'block3_conv4_encode',
+        'wave_let_pooling_2', 'block4_conv1_encode'
+    ],
+    # ===== decoder layers ===== #
+    'de_1': ['block4_conv1_decode'],
+    'unpool_1': [
+        'wave_let_unpooling_2', 'block3_conv4_decode',
+        'block3_conv3_decode', 'block3_conv2_decode'
+    ],
+    'de_2': ['block3_conv1_decode'],
+    'unpool_2': ['wave_let_unpooling_1', 'block2_conv2_decode'],
+    'de_3': ['block2_conv1_decode'],
+    'unpool_3': ['wave_let_unpooling_0', 'block1_conv2_decode'],
+    'final': ['output'],
+}
+
+# number of style images whose features are kept by precompute_style,
+# each entry holds full resolution feature maps on the device
+STYLE_CACHE_SIZE = 1
+
+# training samples waiting to be written before train() blocks
+MAX_PENDING_SAMPLES = 4
+
 class WCT2:
     def __init__(self, base_dir, rst, lr,
                 show_interval=25,
-                gram_loss_weight=1.0):
+                gram_loss_weight=1.0,
+                dtype_policy='mixed_float16',
+                batch_size=None):
+        """
+        dtype_policy: keras mixed precision policy, e.g 'mixed_float16',
+            'mixed_bfloat16' (TPU) or 'float32' to disable it
+        batch_size: training batch size, with rst it fixes the shape
+            of the training graph so XLA compiles it once. Overrides
+            the batch size of the data generator
+        """
         self.base_dir = base_dir
         self.rst = rst
+        self.batch_size = batch_size
         self.lr = lr
         self.show_interval = show_interval
+        # single worker, checkpoint writes never overlap
+        self._save_pool = ThreadPoolExecutor(max_workers=1)
+        self._save_future = None
+        # samples are written to disk by a background thread, at most
+        # MAX_PENDING_SAMPLES of them wait in memory
+        self._viz_pool = ThreadPoolExecutor(max_workers=1)
+        self._viz_slots = threading.BoundedSemaphore(MAX_PENDING_SAMPLES)
+        self.gram_loss_weight = gram_loss_weight
         self.img_shape = (self.rst, self.rst, 3)
-        img = Input(self.img_shape)
+        tf.keras.mixed_precision.set_global_policy(dtype_policy)
         self.wct = self.build_wct_model()
-        # ======= Loss functions ======= #
-        recontruct_img = self.wct(img)
-        
-        self.trainer = Model(inputs=[img], outputs=[recontruct_img], name="trainer")
-        self.trainer.add_loss(gram_loss_weight * self.gram_loss(img, recontruct_img))
-        self.trainer.compile(optimizer=Adam(self.lr), loss=["mse"])
+        self.opt = Adam(self.lr)
+        # running mean of the epoch loss, accumulated on device by train_step
+        self.loss_metric = tf.keras.metrics.Mean(name='loss', dtype='float32')
+        if dtype_policy == 'mixed_float16':
+            # scale the loss to keep float16 gradients from underflowing
+            self.opt = tf.keras.mixed_precision.LossScaleOptimizer(self.opt)
+        batch_spec = tf.TensorSpec((self.batch_size,) + self.img_shape, tf.float32)
+        self.train_step = tf.function(
+            self._train_step, input_signature=[batch_spec], jit_compile=True)
+        self.reconstruct = tf.function(
+            lambda img: self.wct(img, training=False),
+            input_signature=[batch_spec])
 
         self.init_transfer_sequence()
+        self.wct_layer = WhiteningAndColoring()
+        self._style_cache = OrderedDict()
+
+
+    def _train_step(self, img):
+        with tf.GradientTape() as tape:
+            recontruct_img = self.wct(img, training=True)
+            loss = tf.reduce_mean(tf.square(img - recontruct_img))
+            loss += self.gram_loss_weight * self.gram_loss(img, recontruct_img)
+            scaled_loss = loss
+            if isinstance(self.opt, tf.keras.mixed_precision.LossScaleOptimizer):
+                scaled_loss = self.opt.get_scaled_loss(loss)
+
+        variables = self.wct.trainable_variables
+        grads = tape.gradient(scaled_loss, variables)
+        if isinstance(self.opt, tf.keras.mixed_precision.LossScaleOptimizer):
+            grads = self.opt.get_unscaled_gradients(grads)
+        self.opt.apply_gradients(zip(grads, variables))
+        self.loss_metric.update_state(loss)
 
 
     def gram_loss(self, img, gen_img):
-        feat_gens = self.encoder(gen_img)
-        feats = self.encoder(img)
-
-        gram_gen = [gram_matrix(f) for f in feat_gens]
-        gram_in = [gram_matrix(f) for f in feats]
-        num_style_layers = len(gram_gen)
-        loss_list = [
-            K.mean(K.square(gram_gen[i] - gram_in[i])) \
-                for i in range(num_style_layers)
+        # one encoder pass over [img, gen_img] instead of two
+        feats = self.encoder(tf.concat([img, gen_img], axis=0))
+        # gram matrices sum over H*W, too large for float16
+        grams = [
+            tf.split(gram_matrix(tf.cast(f, tf.float32), normalize=False), 2, axis=0) \
+                for f in feats
         ]
-
-        gram_loss = TfReduceSum()(loss_list) / num_style_layers
+        num_style_layers = len(grams)
+
+        # mean((a/n - b/n)^2) == mean((a - b)^2) / n^2, normalize once per layer
+        # after the reduction instead of on every gram entry
+        gram_loss = tf.add_n([
+            tf.reduce_mean(tf.square(gram_gen - gram_in)) / num_locations(f) ** 2 \
+                for f, (gram_in, gram_gen) in zip(feats, grams)
+        ]) / float(num_style_layers)
         return gram_loss
 
 
     def conv_block(self, x, filters, kernel_size,
-                    activation='relu', name=""):
+                    activation='relu', name="", dtype=None, trainable=True):
 
         x = Conv2D(filters, kernel_size=kernel_size, strides=1,
-                    padding='same', activation=activation, name=name)(x)
+                    padding='same', activation=activation, name=name,
+                    dtype=dtype, trainable=trainable)(x)
         return x
 
 
 
-    def copy_layer(self, x, kernel_size, model, layer, name):
+    def copy_layer(self, x, kernel_size, layer, name):
         """
-        Need to copy layer for unique name
+        Need to copy layer for unique name,
+        copied VGG layers are frozen from the start
         """
-        origin_layer = model.get_layer(layer)
-        filters = origin_layer.output_shape[-1]
-        return self.conv_block(x, filters, kernel_size,
-                               name=origin_layer.name + name)
+        return self.conv_block(x, VGG_FILTERS[layer], kernel_size,
+                               name=layer + name, trainable=False)
 
 
 
     def build_wct_model(self):
-        img = Input(self.img_shape, name='in_img')
+        img = Input(self.img_shape, batch_size=self.batch_size, name='in_img')
         kernel_size = 3
         skips = []
 
-        vgg_model = VGG19(include_top=False,
-                         weights='imagenet',
-                         input_tensor=Input(self.img_shape),
-                         input_shape=self.img_shape)
-
-        vgg_model.trainable = False
-        for layer in vgg_model.layers:
-            layer.trainable = False
-
-        self.encoder = Model(inputs=vgg_model.inputs,
-                            outputs=[vgg_model.get_layer('block{}_conv1'.format(i)).get_output_at(0) \
-                                    for i in {1, 2, 3, 4}],
-                            name='encoder')
-
         # ======= Encoder ======= #
         id_ = 0
-        x = self.copy_layer(img, kernel_size, vgg_model,
-                            VGG_LAYERS[0], name='_encode')
+        x = self.copy_layer(img, kernel_size, VGG_LAYERS[0], name='_encode')
         for layer in VGG_LAYERS[1:]:
-            x = self.copy_layer(x, kernel_size, vgg_model, layer, name='_encode')
-            if layer in {'block1_conv2', 'block2_conv2', 'block3_conv4'}:
+            x = self.copy_layer(x, kernel_size, layer, name='_encode')
+            if layer in POOLING_LAYERS:
                 to_append = [x]
                 x, lh, hl, hh= WaveLetPooling('wave_let_pooling_{}'.format(id_))(x)
                 to_append += [lh, hl, hh]
@@ -124,7 +203,7 @@ class WCT2:
         # ======= Decoder ======= #
         skip_id = 2
         for layer in VGG_LAYERS[::-1][:-1]:
-            filters = vgg_model.get_layer(layer).output_shape[-1]
+            filters = VGG_FILTERS[layer]
             name = layer + "_decode"
             if layer in {'block4_conv1', 'block3_conv1', 'block2_conv1'}:
                 x = self.conv_block(x, filters // 2, kernel_size, name=name)
@@ -134,20 +213,47 @@ class WCT2:
             else:
                 x = self.conv_block(x, filters, kernel_size, name=name)
 
-        out = self.conv_block(x, 3, kernel_size, 'linear', name="output")
+        # keep the output in float32 under mixed precision
+        out = self.conv_block(x, 3, kernel_size, 'linear', name="output", dtype='float32')
 
         wct = Model(inputs=img, outputs=out, name='wct')
 
+        # VGG19 is only needed as the source of the encoder weights
+        vgg_model = VGG19(include_top=False,
+                         weights='imagenet',
+                         input_shape=self.img_shape)
+
         for layer in wct.layers:
-            # dont train waveletpooling layers
             if "_encode" in layer.name:
-                name = layer.name.replace("_encode", "")
-                layer.set_weights(vgg_model.get_layer(name).get_weights())
-                layer.trainable=False
+                # tensor to tensor copy, no numpy round trip
+                src = vgg_model.get_layer(layer.name.replace("_encode", ""))
+                layer.kernel.assign(src.kernel)
+                layer.bias.assign(src.bias)
 
+        del vgg_model
+        self.encoder = self.build_encoder(wct)
         return wct
 
 
+    def build_encoder(self, wct):
+        """
+        VGG19 features (block1..4_conv1) for the gram loss, computed
+        with the frozen encoder layers of the wct model. Max pooling
+        replaces the wavelet pooling to match the original VGG19.
+        """
+        img = Input(self.img_shape)
+        outputs = []
+        x = img
+        for layer in VGG_LAYERS:
+            x = wct.get_layer(layer + '_encode')(x)
+            if layer.endswith('_conv1'):
+                outputs.append(x)
+            if layer in POOLING_LAYERS:
+                x = MaxPooling2D((2, 2), strides=(2, 2))(x)
+
+        return Model(inputs=img, outputs=outputs, name='encoder')
+
+
     @staticmethod
     def init_hist():
         return {
@@ -157,23 +263,26 @@ class WCT2:
 
 
     def train(self, data_gen, epochs):
+        # cached style features depend on the decoder weights
+        self.clear_style_cache()
         history = self.init_hist()
-        print("Train on {} samples".format(len(data_gen.x)))
+        print("Train on {} samples".format(len(data_gen)))
 
         for e in range(epochs):
             start_time = datetime.datetime.now()
             print("Train epochs {}/{} - ".format(e + 1, epochs), end="")
 
-            batch_loss = self.init_hist()
-            for content_img in data_gen.next_batch():
-                loss = self.trainer.train_on_batch([content_img], [content_img])
-                batch_loss['loss'].append(loss)
+            last_batch = None
+            for content_img in data_gen.get_batches(self.batch_size):
+                self.train_step(content_img)
+                last_batch = content_img
 
             # evaluate
-            # batch_loss['val_loss'] = 
+            # val_loss_metric = 
 
-            mean_loss = np.mean(np.array(batch_loss['loss']))
-            mean_val_loss = 0#np.mean(np.array(batch_loss['val_loss']))
+            mean_loss = float(self.loss_metric.result())
+            mean_val_loss = 0#float(val_loss_metric.result())
+            self.loss_metric.reset_state()
 
             history['loss'].append(mean_loss)
             history['val_loss'].append(mean_val_loss)
@@ -183,14 +292,35 @@ class WCT2:
                 datetime.datetime.now() - start_time
             ))
 
-            if e % self.show_interval == 0:
-                self.save_weight()
-                idx = np.random.randint(0, data_gen.max_size - 1)
-                img = data_gen.x[idx:idx+1]
-                gen_img = self.wct.predict(img)
-                data_gen.show_imgs(np.concatenate([img, gen_img]))
+            self.show_progress(data_gen, e, last_batch)
 
         self.history = history
+        self.wait_save()
+
+
+    def show_progress(self, data_gen, e, content_img):
+        # no sample when the epoch had no complete batch
+        if e % self.show_interval == 0 and content_img is not None:
+            self.save_weight()
+            # reconstruct a whole batch, the graph has a fixed batch size
+            gen_img = self.reconstruct(content_img).numpy()
+            samples = np.concatenate([content_img[:1].numpy(), gen_img[:1]])
+
+            self._viz_slots.acquire()
+            future = self._viz_pool.submit(
+                self._dump_samples, samples, e,
+                data_gen.normalize, data_gen.preprocessing)
+            future.add_done_callback(lambda f: self._viz_slots.release())
+
+
+    def _dump_samples(self, samples, epoch, denorm, deprocess):
+        try:
+            sample_dir = os.path.join(self.base_dir, 'samples')
+            os.makedirs(sample_dir, exist_ok=True)
+            utils.save_images(samples, os.path.join(sample_dir, 'epoch_{}.png'.format(epoch)),
+                              denorm, deprocess)
+        except Exception as e:
+            print("Save samples failed, {}".format(str(e)))
 
 
     def plot_history(self):
@@ -204,122 +334,213 @@ class WCT2:
 
 
     def save_weight(self):
+        """
+        Weights are copied to host memory here, writing them to disk
+        happens in the background while training goes on
+        """
         try:
-            self.wct.save_weights(self.base_dir + '/wct2.h5')
+            weights = self.wct.get_weights()
         except Exception as e:
             print("Save model failed, {}".format(str(e)))
+            return
+
+        self._save_future = self._save_pool.submit(
+            _write_weights, weights, self.base_dir + '/wct2.pkl')
+        self._save_future.add_done_callback(_report_save_error)
+
+
+    def wait_save(self):
+        if self._save_future is not None:
+            self._save_future.exception()
 
 
     def load_weight(self):
+        """
+        Load the newest of wct2.pkl (written by save_weight) and
+        wct2.h5 (keras format, e.g the published weights)
+        """
         try:
-            self.wct.load_weights(self.base_dir + '/wct2.h5')
+            pkl_path = self.base_dir + '/wct2.pkl'
+            h5_path = self.base_dir + '/wct2.h5'
+            if os.path.exists(pkl_path) and (not os.path.exists(h5_path) or \
+                    os.path.getmtime(pkl_path) >= os.path.getmtime(h5_path)):
+                self.wct.set_weights(utils.pickle_load(pkl_path))
+                print("Loaded weights from {}".format(pkl_path))
+            else:
+                self.wct.load_weights(h5_path)
+                print("Loaded weights from {}".format(h5_path))
         except Exception as e:
             print("Could not load model, {}".format(str(e))) 
+        self.clear_style_cache()
+
+
+    def clear_style_cache(self):
+        self._style_cache.clear()
 
 
-    def transfer(self, content_img, style_img, alpha=1.0):
+    def precompute_style(self, style_img, fused=True):
+        """
+        Run the style image through every transfer stage once, the
+        returned features can be reused for many content images
+        """
+        style_arr = np.ascontiguousarray(style_img)
+        key = (style_arr.shape, hashlib.sha1(style_arr.tobytes()).hexdigest())
+        if key in self._style_cache:
+            self._style_cache.move_to_end(key)
+            return self._style_cache[key]
+
+        style_img = tf.cast(style_img, tf.float32)
+        if fused:
+            style = self.style_graph(style_img)
+        else:
+            style = self._encode_style(style_img, self.split_stages)
+
+        self._style_cache[key] = style
+        if len(self._style_cache) > STYLE_CACHE_SIZE:
+            self._style_cache.popitem(last=False)
+        return style
+
+
+    def transfer(self, content_imgs, style, alpha=1.0, return_tensor=False, fused=True):
+        """
+        content_imgs: batch of content images (NxHxWx3), all stylized
+            with the same style
+        style: style image or the features returned by precompute_style.
+            Features of the last STYLE_CACHE_SIZE style images are kept
+            on the device, the cache is cleared when weights change
+        return_tensor: return the tf tensor and leave the device -> host
+            copy to the caller
+        fused: run the whole transfer as one traced graph, False runs
+            the split stage functions one by one
+        """
+        if not isinstance(style, dict):
+            style = self.precompute_style(style, fused)
+
+        content_feat = self._run_transfer(content_imgs, style, alpha, fused)
+        return content_feat if return_tensor else content_feat.numpy()
+
+
+    def transfer_many(self, content_list, style, alpha=1.0, fused=True):
+        """
+        Stylize a list of content images (possibly of different sizes),
+        all transfers are queued before the results are copied back
+        """
+        if not isinstance(style, dict):
+            style = self.precompute_style(style, fused)
+
+        results = [self._run_transfer(content, style, alpha, fused) for content in content_list]
+        return [r.numpy() for r in tf.identity_n(results)]
+
+
+    def _run_transfer(self, content_imgs, style, alpha, fused):
+        content_imgs = tf.cast(content_imgs, tf.float32)
+        if not fused:
+            return self._transfer_tf(content_imgs, style, alpha, self.split_stages)
+
+        if self.transfer_graph is None:
+            style_spec = tf.nest.map_structure(relaxed_spec, style)
+            self.transfer_graph = tf.function(
+                lambda c, s, a: self._transfer_tf(c, s, a, self.fused_stages),
+                input_signature=[
+                    tf.TensorSpec((None, None, None, 3), tf.float32),
+                    style_spec,
+                    tf.TensorSpec((), tf.float32),
+                ])
+
+        return self.transfer_graph(content_imgs, style, alpha)
+
+
+    def _encode_style(self, style_img, stages):
+        style = {}
+        # ===== Encode ===== #
+        style['en_1'] = stages['en_1'](style_img)
+        style['pool_1'], style['skips_1'] = stages['pool_1'](style['en_1'])
+        style['pool_2'], style['skips_2'] = stages['pool_2'](style['pool_1'])
+        style['pool_3'], style['skips_3'] = stages['pool_3'](style['pool_2'])
+        # ===== Decode ===== #
+        style['de_1'] = stages['de_1'](style['pool_3'])
+        style['unpool_1'] = stages['unpool_1']([style['de_1']] + style['skips_3'])
+        style['unpool_2'] = stages['unpool_2']([stages['de_2'](style['unpool_1'])] + style['skips_2'])
+        style['unpool_3'] = stages['unpool_3']([stages['de_3'](style['unpool_2'])] + style['skips_1'])
+        return style
+
+
+    def _transfer_tf(self, content_imgs, style, alpha, stages):
         # ===== Encode ===== #
         # step 1.
-        content_feat, style_feat = self.en_1([content_img]), self.en_1([style_img])
-        content_feat = WhiteningAndColoring(alpha)([content_feat, style_feat])
+        content_feat = stages['en_1'](content_imgs)
+        content_feat = self.wct_layer([content_feat, style['en_1']], alpha=alpha)
         # step 2.
-        content_feat, c_skips_1 = self.pool_1([content_feat])
-        style_feat, s_skips_1 = self.pool_1([style_feat])
-        c_skips_1 = [WhiteningAndColoring(alpha)([c_skips_1[i], s_skips_1[i]]) for i in range(4)]
-        content_feat = WhiteningAndColoring(alpha)([content_feat, style_feat])
+        content_feat, c_skips_1 = stages['pool_1'](content_feat)
+        c_skips_1 = self.transfer_skips(c_skips_1, style['skips_1'], alpha)
+        content_feat = self.wct_layer([content_feat, style['pool_1']], alpha=alpha)
         # step 3.
-        content_feat, c_skips_2 = self.pool_2([content_feat])
-        style_feat, s_skips_2 = self.pool_2([style_feat])
-        c_skips_2 = [WhiteningAndColoring(alpha)([c_skips_2[i], s_skips_2[i]]) for i in range(4)]
-        content_feat = WhiteningAndColoring(alpha)([content_feat, style_feat])
+        content_feat, c_skips_2 = stages['pool_2'](content_feat)
+        c_skips_2 = self.transfer_skips(c_skips_2, style['skips_2'], alpha)
+        content_feat = self.wct_layer([content_feat, style['pool_2']], alpha=alpha)
         # step 4.
-        content_feat, c_skips_3 = self.pool_3([content_feat])
-        style_feat, s_skips_3 = self.pool_3([style_feat])
-        c_skips_3 = [WhiteningAndColoring(alpha)([c_skips_3[i], s_skips_3[i]]) for i in range(4)]
-        content_feat = WhiteningAndColoring(alpha)([content_feat, style_feat])
+        content_feat, c_skips_3 = stages['pool_3'](content_feat)
+        c_skips_3 = self.transfer_skips(c_skips_3, style['skips_3'], alpha)
+        content_feat = self.wct_layer([content_feat, style['pool_3']], alpha=alpha)
 
         # ===== Decode ===== #
         # step 1.
-        content_feat, style_feat = self.de_1([content_feat]), self.de_1([style_feat])
-        content_feat = WhiteningAndColoring(alpha)([content_feat, style_feat])
+        content_feat = stages['de_1'](content_feat)
+        content_feat = self.wct_layer([content_feat, style['de_1']], alpha=alpha)
         # step 2.
-        content_feat = self.unpool_1([content_feat] + c_skips_3)
-        style_feat = self.unpool_1([style_feat] + s_skips_3)
-        content_feat = WhiteningAndColoring(alpha)([content_feat, style_feat])
-        content_feat = self.de_2([content_feat])
-        style_feat = self.de_2([style_feat])
+        content_feat = stages['unpool_1']([content_feat] + c_skips_3)
+        content_feat = self.wct_layer([content_feat, style['unpool_1']], alpha=alpha)
+        content_feat = stages['de_2'](content_feat)
         # step 3.
-        content_feat = self.unpool_2([content_feat] + c_skips_2)
-        style_feat = self.unpool_2([style_feat] + s_skips_2)
-        content_feat = WhiteningAndColoring(alpha)([content_feat, style_feat])
-        content_feat = self.de_3([content_feat])
-        style_feat = self.de_3([style_feat])
-
-        content_feat = self.unpool_3([content_feat] + c_skips_1)
-        style_feat = self.unpool_3([style_feat] + s_skips_1)
-
-        content_feat = WhiteningAndColoring(alpha)([content_feat, style_feat])
-
-
-        content_feat = self.final([content_feat])
-
-        return content_feat.numpy()
-
+        content_feat = stages['unpool_2']([content_feat] + c_skips_2)
+        content_feat = self.wct_layer([content_feat, style['unpool_2']], alpha=alpha)
+        content_feat = stages['de_3'](content_feat)
 
-    def init_transfer_sequence(self):
-        # ===== encoder layers ===== #
-        self.en_1 = get_predict_function(self.wct, ['in_img', 'block1_conv1_encode'], name='en_1')
+        content_feat = stages['unpool_3']([content_feat] + c_skips_1)
 
-        self.pool_1 = get_predict_function(
-            self.wct,
-            ['block1_conv2_encode', 'wave_let_pooling_0', 'block2_conv1_encode'],
-            name='pool_1')
+        content_feat = self.wct_layer([content_feat, style['unpool_3']], alpha=alpha)
 
-        self.pool_2 = get_predict_function(
-            self.wct,
-            ['block2_conv2_encode', 'wave_let_pooling_1', 'block3_conv1_encode'],
-            name='pool_2')
 
-        self.pool_3 = get_predict_function(
-            self.wct,
-            [
-                'block3_conv2_encode', 'block3_conv3_encode',
-                'block3_conv4_encode',
-                'wave_let_pooling_2', 'block4_conv1_encode'
-            ],
-            name='pool_3')
+        content_feat = stages['final'](content_feat)
 
-        # ===== decoder layers ===== #
-        self.de_1 = get_predict_function(self.wct, ['block4_conv1_decode'], name='de_1')
+        return content_feat
 
-        self.unpool_1 = get_predict_function(
-            self.wct,
-            [
-                'wave_let_unpooling_2', 'block3_conv4_decode',
-                'block3_conv3_decode', 'block3_conv2_decode'
-            ],
-            name='unpool_1')
 
-        self.de_2 = get_predict_function(self.wct, ['block3_conv1_decode'], name='de_2')
+    def transfer_skips(self, c_skips, s_skips, alpha):
+        """
+        skips are [lh, hl, hh, pre-pooling feature], the 3 wavelet
+        bands share a shape and are colored by a single stacked call
+        """
+        bands = self.wct_layer(
+            [tf.stack(c_skips[:3], axis=0), tf.stack(s_skips[:3], axis=0)], alpha=alpha)
+        original = self.wct_layer([c_skips[3], s_skips[3]], alpha=alpha)
+        return tf.unstack(bands, num=3, axis=0) + [original]
 
-        self.unpool_2 = get_predict_function(
-            self.wct,
-            ['wave_let_unpooling_1', 'block2_conv2_decode'],
-            name='unpool_2')
 
-        self.de_3 = get_predict_function(self.wct, ['block2_conv1_decode'], name='de_3')
+    def init_transfer_sequence(self):
+        # fallback, one traced function per stage
+        self.split_stages = {
+            name: get_predict_function(self.wct, layers, name=name) \
+                for name, layers in TRANSFER_STAGES.items()
+        }
 
-        self.unpool_3 = get_predict_function(
-            self.wct,
-            ['wave_let_unpooling_0', 'block1_conv2_decode'],
-            name='unpool_3')
+        # stages call the wct layers directly so the whole
+        # transfer can be traced into a single graph
+        self.fused_stages = {
+            name: functools.partial(apply_layers, self.wct, layers) \
+                for name, layers in TRANSFER_STAGES.items()
+        }
 
-        self.final = get_predict_function(self.wct, ['output'], name='final')
+        self.style_graph = tf.function(
+            lambda s: self._encode_style(s, self.fused_stages),
+            input_signature=[tf.TensorSpec((None, None, None, 3), tf.float32)])
+        # built on first use, its signature follows the style features
+        self.transfer_graph = None
 
 
 
     def generate(self, content_imgs, style_imgs):
-        return self.wct.predict([content_imgs, style_imgs])
+        return self.transfer(content_imgs, style_imgs)
 
 
     def show_sample(self, content_img, style_img,
@@ -341,3 +562,17 @@ class WCT2:
         cv2_imshow(content_img[0])
         cv2_imshow(style_img[0])
         cv2_imshow(gen_img[0])
+
+
+def _write_weights(weights, path):
+    # write to a temp file then rename, an interrupted
+    # save never leaves a truncated checkpoint behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(weights, f)
+    os.replace(tmp_path, path)
+
+
+def _report_save_error(future):
+    if future.exception() is not None:
+        print("Save model failed, {}".format(str(future.exception())))
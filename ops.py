@@ -25,7 +25,7 @@ class WaveLetPooling(tf.keras.layers.Layer):
 
 
     def call(self, inputs):
-        LL, LH, HL, HH = self.repeat_filters(inputs.shape[-1])
+        LL, LH, HL, HH = self.repeat_filters(inputs.shape[-1], inputs.dtype)
         return [_conv2d(inputs, LL),
                 _conv2d(inputs, LH),
                 _conv2d(inputs, HL),
@@ -39,12 +39,10 @@ class WaveLetPooling(tf.keras.layers.Layer):
         return [shape, shape, shape, shape]
 
 
-    def repeat_filters(self, repeats):
+    def repeat_filters(self, repeats, dtype=tf.float32):
         return [
-            tf.transpose(tf.repeat(self.LL, repeats, axis=0), (1, 2, 3, 0)),
-            tf.transpose(tf.repeat(self.LH, repeats, axis=0), (1, 2, 3, 0)),
-            tf.transpose(tf.repeat(self.HL, repeats, axis=0), (1, 2, 3, 0)),
-            tf.transpose(tf.repeat(self.HH, repeats, axis=0), (1, 2, 3, 0))
+            tf.cast(tf.transpose(tf.repeat(f, repeats, axis=0), (1, 2, 3, 0)), dtype)
+                for f in (self.LL, self.LH, self.HL, self.HH)
         ]
 
 
@@ -70,8 +68,12 @@ class WaveLetUnPooling(tf.keras.layers.Layer):
 
     def call(self, inputs):
         LL_in, LH_in, HL_in, HH_in, tensor_in = inputs
-        LL, LH, HL, HH = self.repeat_filters(LL_in.shape[-1])
-        out_shape = tf.shape(tensor_in)
+        LL, LH, HL, HH = self.repeat_filters(LL_in.shape[-1], LL_in.dtype)
+        # static shape when known, lets XLA specialize the kernels
+        if tensor_in.shape.is_fully_defined():
+            out_shape = tensor_in.shape.as_list()
+        else:
+            out_shape = tf.shape(tensor_in)
 
         return tf.concat([
             _conv2d_transpose(LL_in, LL, output_shape=out_shape),
@@ -94,12 +96,10 @@ class WaveLetUnPooling(tf.keras.layers.Layer):
         return shape
 
 
-    def repeat_filters(self, repeats):
+    def repeat_filters(self, repeats, dtype=tf.float32):
         return [
-            tf.transpose(tf.repeat(self.LL, repeats, axis=0), (1, 2, 3, 0)),
-            tf.transpose(tf.repeat(self.LH, repeats, axis=0), (1, 2, 3, 0)),
-            tf.transpose(tf.repeat(self.HL, repeats, axis=0), (1, 2, 3, 0)),
-            tf.transpose(tf.repeat(self.HH, repeats, axis=0), (1, 2, 3, 0)),
+            tf.cast(tf.transpose(tf.repeat(f, repeats, axis=0), (1, 2, 3, 0)), dtype)
+                for f in (self.LL, self.LH, self.HL, self.HH)
         ]
 
 class WhiteningAndColoring(tf.keras.layers.Layer):
@@ -107,55 +107,75 @@ class WhiteningAndColoring(tf.keras.layers.Layer):
     https://github.com/eridgd/WCT-TF/blob/master/ops.py#L24
     """
     def __init__(self, alpha=1.0):
-        super(WhiteningAndColoring, self).__init__()
+        # covariance + eigh need float32 even under mixed precision
+        super(WhiteningAndColoring, self).__init__(dtype='float32')
         self.alpha = alpha
 
 
-    def call(self, inputs):
+    def call(self, inputs, alpha=None):
         """
-        Make it works first .
+        content: NxHxWxC, style: 1xHsxWsxC or NxHsxWsxC, Ns must be
+        1 (a single style shared by the whole content batch) or N.
+        GxNxHxWxC / GxNsxHsxWsxC stacks of G same shaped features are
+        merged into the batch and transformed in one call
+        alpha: overrides the blending weight given at construction
         """
         content, style = inputs
         eps = 1e-8
-        alpha = self.alpha
-        
-        content_t = tf.transpose(tf.squeeze(content), (2, 0, 1))
-        style_t = tf.transpose(tf.squeeze(style), (2, 0, 1))
+        alpha = self.alpha if alpha is None else alpha
+
+        batch_axis = content.shape.rank - 4
+        content_batch = tf.shape(content)[batch_axis]
+        style_batch = tf.shape(style)[batch_axis]
+        tf.debugging.assert_equal(
+            tf.logical_or(tf.equal(style_batch, 1), tf.equal(style_batch, content_batch)), True,
+            message="style batch size must be 1 or equal to the content batch size")
 
-        Cc, Hc, Wc = tf.unstack(tf.shape(content_t))
-        Cs, Hs, Ws = tf.unstack(tf.shape(style_t))
+        grouped_shape = None
+        if content.shape.rank == 5:
+            grouped_shape = tf.shape(content)
+            content = tf.reshape(content, tf.concat([[-1], grouped_shape[2:]], axis=0))
+            style = tf.reshape(style, tf.concat([[-1], tf.shape(style)[2:]], axis=0))
 
-        # CxHxW -> CxH*W
-        content_flat = tf.reshape(content_t, (Cc, Hc*Wc))
-        style_flat = tf.reshape(style_t, (Cs, Hs*Ws))
+        content_shape = tf.shape(content)
+        N, Hc, Wc, Cc = tf.unstack(content_shape)
+        Ns, Hs, Ws, Cs = tf.unstack(tf.shape(style))
+
+        # NxHxWxC -> NxCxH*W
+        content_flat = tf.transpose(tf.reshape(content, (N, Hc*Wc, Cc)), (0, 2, 1))
+        style_flat = tf.transpose(tf.reshape(style, (Ns, Hs*Ws, Cs)), (0, 2, 1))
 
         # Content covariance
-        mc = tf.reduce_mean(content_flat, axis=1, keepdims=True)
+        mc = tf.reduce_mean(content_flat, axis=2, keepdims=True)
         fc = content_flat - mc
         fcfc = tf.matmul(fc, fc, transpose_b=True) / (tf.cast(Hc*Wc, tf.float32) - 1.) + tf.eye(Cc)*eps
 
         # Style covariance
-        ms = tf.reduce_mean(style_flat, axis=1, keepdims=True)
+        ms = tf.reduce_mean(style_flat, axis=2, keepdims=True)
         fs = style_flat - ms
         fsfs = tf.matmul(fs, fs, transpose_b=True) / (tf.cast(Hs*Ws, tf.float32) - 1.) + tf.eye(Cs)*eps
 
-        # tf.svd is slower on GPU, see https://github.com/tensorflow/tensorflow/issues/13603
-        with tf.device('/cpu:0'):  
-            Sc, Uc, _ = tf.linalg.svd(fcfc)
-            Ss, Us, _ = tf.linalg.svd(fsfs)
+        # Covariances are symmetric PSD, eigh gives the same decomposition
+        # as svd at a fraction of the cost, content and style are
+        # decomposed together in one batched call
+        S, U = tf.linalg.eigh(tf.concat([fcfc, fsfs], axis=0))
+        Sc, Ss = tf.split(S, [N, Ns], axis=0)
+        Uc, Us = tf.split(U, [N, Ns], axis=0)
 
-        # Filter small singular values
-        k_c = tf.reduce_sum(tf.cast(tf.greater(Sc, 1e-5), tf.float32)).numpy()
-        k_s = tf.reduce_sum(tf.cast(tf.greater(Ss, 1e-5), tf.float32)).numpy()
+        # Filter small eigenvalues, masked rather than sliced
+        # so every sample of the batch keeps the same shape
+        Dc = tf.linalg.diag(tf.where(Sc > 1e-5, tf.math.rsqrt(Sc), tf.zeros_like(Sc)))
+        Ds = tf.linalg.diag(tf.where(Ss > 1e-5, tf.sqrt(tf.maximum(Ss, 0.)), tf.zeros_like(Ss)))
 
-        k_c, k_s = int(k_c), int(k_s)
         # Whiten content feature
-        Dc = tf.linalg.diag(tf.pow(Sc[:k_c], -0.5))
-        fc_hat = tf.matmul(tf.matmul(tf.matmul(Uc[:,:k_c], Dc), Uc[:,:k_c], transpose_b=True), fc)
+        fc_hat = tf.matmul(tf.matmul(tf.matmul(Uc, Dc), Uc, transpose_b=True), fc)
 
-        # Color content with style
-        Ds = tf.linalg.diag(tf.pow(Ss[:k_s], 0.5))
-        fcs_hat = tf.matmul(tf.matmul(tf.matmul(Us[:,:k_s], Ds), Us[:,:k_s], transpose_b=True), fc_hat)
+        # Color content with style, style statistics are computed
+        # once and repeated over the content batch
+        coloring = tf.matmul(tf.matmul(Us, Ds), Us, transpose_b=True)
+        coloring = tf.repeat(coloring, N // Ns, axis=0)
+        ms = tf.repeat(ms, N // Ns, axis=0)
+        fcs_hat = tf.matmul(coloring, fc_hat)
 
         # Re-center with mean of style
         fcs_hat = fcs_hat + ms
@@ -163,22 +183,14 @@ class WhiteningAndColoring(tf.keras.layers.Layer):
         # Blend whiten-colored feature with original content feature
         blended = alpha * fcs_hat + (1 - alpha) * (fc + mc)
 
-        # CxH*W -> CxHxW
-        blended = tf.reshape(blended, (Cc,Hc,Wc))
-        # CxHxW -> 1xHxWxC
-        blended = tf.expand_dims(tf.transpose(blended, (1,2,0)), 0)
+        # NxCxH*W -> NxHxWxC
+        blended = tf.reshape(tf.transpose(blended, (0, 2, 1)), content_shape)
+        if grouped_shape is not None:
+            blended = tf.reshape(blended, grouped_shape)
 
         return blended
 
 
-class TfReduceSum(tf.keras.layers.Layer):
-    def __init__(self):
-        super(TfReduceSum, self).__init__()
-
-    def call(self, inputs):
-        return tf.reduce_sum(inputs)
-
-
 def _conv2d_transpose(x, kernel, output_shape):
     conv = tf.nn.conv2d_transpose(
             x, kernel,
@@ -202,44 +214,84 @@ def _get_output(x, layer):
 
 
 def _copy_input(layer):
-    # :1 to remove batch_size
-    if hasattr(layer, 'input_shape'):
-        ip_shape = layer.input_shape[1:]
+    # :1 to remove batch_size. Node 0 is the wct graph, shared layers
+    # also have (encoder / stage) nodes with a different batch size,
+    # which makes layer.input_shape ambiguous
+    if isinstance(layer, tf.keras.layers.Layer):
+        ip_shape = layer.get_input_shape_at(0)[1:]
     else:
         ip_shape = layer.shape[1:]
-    return tf.keras.layers.Input(shape=ip_shape)
+    # only the channels are fixed, stages run at any resolution
+    return tf.keras.layers.Input(shape=[None] * (len(ip_shape) - 1) + [ip_shape[-1]])
 
 
-def get_predict_function(model, layers, name):
+def _tensor_spec(tensor):
+    return tf.TensorSpec(tensor.shape, tensor.dtype)
+
+
+def relaxed_spec(tensor):
+    # keep only the channels, any batch size / resolution
+    return tf.TensorSpec([None] * (tensor.shape.rank - 1) + [tensor.shape[-1]], tensor.dtype)
+
+
+def apply_layers(model, layers, x):
+    """
+    Run the model layers of one transfer stage on x. Called directly
+    by the fused transfer graph, and wrapped into a Keras model by
+    get_predict_function
+    """
     skips_out = None
+    start = 1 if layers[0] == 'in_img' else 0
+    for l in layers[start:]:
+        x, skips = _get_output(x, model.get_layer(l))
+        if skips is not None:
+            skips_out = skips
+
+    outputs = x if skips_out is None else [x, skips_out]
+    # stages exchange float32 tensors whatever the compute policy is
+    return tf.nest.map_structure(lambda t: tf.cast(t, tf.float32), outputs)
 
+
+def get_predict_function(model, layers, name):
     if layers[0] == 'in_img':
-        ip = model.get_layer(layers[0]).input
-        start = 1
+        # new input, the model one may have a fixed batch size / resolution
+        ip = _copy_input(model.get_layer(layers[0]).output)
     elif 'unpooling' in layers[0]:
         # multi inputs
         ip = [
-            _copy_input(l) for l in model.get_layer(layers[0]).input
+            _copy_input(l) for l in model.get_layer(layers[0]).get_input_at(0)
         ]
-        start = 0
     else:
         ip = _copy_input(model.get_layer(layers[0]))
-        start = 0
 
-    x, skips = _get_output(ip, model.get_layer(layers[start]))
-    if skips is not None:
-        skips_out = skips
-    for l in layers[start + 1:]:
-        x, skips = _get_output(x, model.get_layer(l))
-        if skips is not None:
-            skips_out = skips
+    predict_model = tf.keras.models.Model(
+        inputs=ip, outputs=apply_layers(model, layers, ip), name=name)
+
+    # trace once for any batch size / resolution
+    if isinstance(ip, list):
+        input_signature = [[_tensor_spec(t) for t in ip]]
+    else:
+        input_signature = [_tensor_spec(ip)]
 
-    outputs = [x] if skips_out is None else [x, skips_out]
-    return tf.keras.models.Model(inputs=ip, outputs=outputs, name=name)
+    return tf.function(lambda x: predict_model(x, training=False),
+                       input_signature=input_signature)
 
 
-def gram_matrix(input_tensor):
-    result = tf.linalg.einsum('bijc,bijd->bcd', input_tensor, input_tensor)
+def num_locations(input_tensor):
+    """
+    H*W of a feature map, a python constant when the
+    resolution is known at build time
+    """
+    height, width = input_tensor.shape[1], input_tensor.shape[2]
+    if height is not None and width is not None:
+        return float(height * width)
+
     input_shape = tf.shape(input_tensor)
-    num_locations = tf.cast(input_shape[1]*input_shape[2], tf.float32)
-    return result/(num_locations)
+    return tf.cast(input_shape[1]*input_shape[2], tf.float32)
+
+
+def gram_matrix(input_tensor, normalize=True):
+    result = tf.linalg.einsum('bijc,bijd->bcd', input_tensor, input_tensor)
+    if not normalize:
+        return result
+    return result/num_locations(input_tensor)
@@ -52,6 +52,15 @@ def deprocess(imgs):
 
 
 def show_images(img_array, denorm=True, deprcs=True):
+    cv2_imshow(images_grid(img_array, denorm, deprcs))
+
+
+def save_images(img_array, path, denorm=True, deprcs=True):
+    img = images_grid(img_array, denorm, deprcs)
+    cv2.imwrite(path, np.clip(img, 0, 255).astype(np.uint8))
+
+
+def images_grid(img_array, denorm=True, deprcs=True):
     shape = img_array.shape
     img_array = img_array.reshape(
         (-1, shape[-4], shape[-3], shape[-2], shape[-1])
@@ -75,7 +84,7 @@ def show_images(img_array, denorm=True, deprcs=True):
     if deprcs:
         img = deprocess(img)
 
-    cv2_imshow(img)
+    return img
 
 
 def http_get_img(url, rst=64, _preprocess=False, normalize=False):